@@ -1,10 +1,17 @@
 import os
+import html
 import pandas as pd
-import requests
+import time
+import random
 import logging
 import asyncio
-from telegram import Bot
+import functools
+from dataclasses import dataclass
+import aiohttp
+import orjson
+import ijson
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 from dotenv import load_dotenv
 
@@ -14,39 +21,193 @@ load_dotenv()
 # Constants from .env
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 CHAT_ID = os.getenv('CHAT_ID')
+AUTO_NOTIFY = os.getenv('AUTO_NOTIFY', 'N')
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
-# Initialize settings with default values
-settings = {
-    'auto_notify': 'N',
-    'interval': 1,  # Default to 1 hour if not set
-    'threshold': 300  # Default to $300 if not set
-}
+# Bot settings with default values
+@dataclass(slots=True)
+class Settings:
+    auto_notify: str = 'N'
+    interval: int = 1  # Default to 1 hour if not set
+    threshold: float = 300  # Default to $300 if not set
+
+# Initialize settings with default values, auto notifications can be enabled from .env
+settings = Settings(auto_notify=AUTO_NOTIFY)
+
+# Number of blocks covered by each MEV check
+BLOCK_WINDOW = 50000
+
+# Rolling MEV window kept between checks, the last block height it covers and the threshold it was filtered with
+mev_window = None
+last_seen_height = None
+mev_window_threshold = None
+
+# Skip a check when fewer new blocks than this have been produced since the last one
+MIN_NEW_BLOCKS = 10
+
+# Validator sets change slowly, so refresh them at most every 15 minutes
+VALIDATOR_CACHE_TTL = 900
+
+# Cache of the last fetched validator data: (fetched_at, {pubkey: moniker})
+validator_cache = None
+
+# Telegram rejects messages over 4096 characters, keep some headroom
+MAX_MESSAGE_LENGTH = 4000
+
+# Retry policy for transient API failures: attempts and initial backoff in seconds
+RETRY_ATTEMPTS = 3
+RETRY_START_TIMEOUT = 0.3
+
+# Upper bound in seconds for a single API request, including streaming the response body
+REQUEST_TIMEOUT = 60
+
+# Shared HTTP session, created lazily inside the running event loop
+http_session = None
+
+# Function to get the shared HTTP session
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        # Every request goes to observatory.zone, so pool per host and cache its DNS lookup
+        connector = aiohttp.TCPConnector(limit=20, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=60)
+        # aiohttp decompresses gzip natively and brotli when the Brotli package is installed
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            headers={'Accept-Encoding': 'gzip, br'},
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+        )
+    return http_session
+
+# Function to decode a whole JSON response body
+async def read_json(response):
+    return orjson.loads(await response.read())
+
+# Function to fetch a URL and parse the response, retrying transient failures with jittered backoff
+async def fetch(url, parse=read_json):
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            async with get_http_session().get(url) as response:
+                response.raise_for_status()
+                return await parse(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status >= 500
+            if not retryable or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            delay = RETRY_START_TIMEOUT * 2**attempt
+            logging.warning(f"Request to {url} failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay + random.uniform(0, delay))
+
+# Function to stream MEV datapoints, keeping only blocks above the threshold
+async def read_mev_datapoints(response, threshold):
+    min_value = threshold * 10**6
+    heights, values, proposers = [], [], []
+    async for datapoint in ijson.items_async(response.content, 'datapoints.item'):
+        value = float(datapoint['value'])
+        if value > min_value:
+            heights.append(int(datapoint['height']))
+            values.append(value)
+            proposers.append(datapoint['proposer'])
+    return {'height': heights, 'value': values, 'proposer': proposers}
 
 # Function to get MEV data
-def get_mev_data(initial_block_height, final_block_height):
+async def get_mev_data(initial_block_height, final_block_height, threshold):
     mev_api_url = f"https://dydx.observatory.zone/api/v1/raw_mev?limit=500000&from_height={initial_block_height}&to_height={final_block_height}&with_block_info=True"
-    mev_response = requests.get(mev_api_url)
-    mev_data = mev_response.json()
-    mev_datapoints = mev_data.get('datapoints', [])
-    return pd.DataFrame(mev_datapoints)
+    mev_columns = await fetch(mev_api_url, functools.partial(read_mev_datapoints, threshold=threshold))
+    mev_df = pd.DataFrame(mev_columns)
+    if mev_df.empty:
+        # Give empty frames numeric columns so concatenating them never turns the window into object dtype
+        return mev_df.astype({'height': 'int32', 'value': 'float32'})
+    mev_df['value'] = pd.to_numeric(mev_df['value'], downcast='float')
+    mev_df['height'] = pd.to_numeric(mev_df['height'], downcast='integer')
+    return mev_df
+
+# Function to get MEV data for the current window, fetching only blocks not seen yet
+async def get_mev_window(final_block_height):
+    global mev_window, last_seen_height, mev_window_threshold
+    initial_block_height = final_block_height - BLOCK_WINDOW
+    threshold = settings.threshold
+    if (
+        mev_window is None
+        or last_seen_height is None
+        or not initial_block_height <= last_seen_height <= final_block_height
+        or threshold != mev_window_threshold
+    ):
+        # First run, a gap larger than the window or a new threshold: fall back to a full fetch
+        mev_window = await get_mev_data(initial_block_height, final_block_height, threshold)
+        mev_window_threshold = threshold
+    elif last_seen_height < final_block_height:
+        new_df = await get_mev_data(last_seen_height + 1, final_block_height, threshold)
+        if not new_df.empty:
+            mev_window = pd.concat([mev_window, new_df], ignore_index=True)
+    last_seen_height = final_block_height
+
+    if not mev_window.empty:
+        mev_window = mev_window[mev_window['height'] >= initial_block_height].reset_index(drop=True)
+    return mev_window.copy()
 
-# Function to get validator data
-def get_validator_data():
+# Function to get a pubkey -> moniker lookup of validators, served from cache while it is fresh
+async def get_validator_lookup():
+    global validator_cache
+    if validator_cache is not None and time.monotonic() - validator_cache[0] < VALIDATOR_CACHE_TTL:
+        return validator_cache[1]
     validator_api_url = "https://dydx.observatory.zone/api/v1/validator"
-    validator_response = requests.get(validator_api_url)
-    validator_data = validator_response.json()
-    return pd.DataFrame(validator_data.get('validators', []))
+    validator_data = await fetch(validator_api_url)
+    validator_lookup = {validator['pubkey']: validator['moniker'] for validator in validator_data.get('validators', [])}
+    validator_cache = (time.monotonic(), validator_lookup)
+    return validator_lookup
 
 # Function to process and filter MEV data
-def process_data(mev_df, validator_df):
-    mev_df['value'] = mev_df['value'].astype(float)
-    mev_df['height'] = mev_df['height'].astype(int)
+def process_data(mev_df, validator_lookup):
     mev_df['MEV value ($)'] = mev_df['value'] / 10**6
-    merged_df = pd.merge(mev_df, validator_df, left_on='proposer', right_on='pubkey', how='left')
-    return merged_df[merged_df['MEV value ($)'] > settings['threshold']]
+    # Filter first, on the raw ndarray, so the lookup only sees the few blocks above the threshold.
+    # Streaming already dropped blocks below the threshold the window was fetched with, this is the authoritative check.
+    mask = mev_df['MEV value ($)'].to_numpy() > settings.threshold
+    filtered_df = mev_df.iloc[mask]
+    return filtered_df.assign(moniker=filtered_df['proposer'].map(validator_lookup))
+
+# Function to format the filtered blocks as a monospaced table, returning its column header and rows
+def format_blocks(filtered_df):
+    table = filtered_df[['height', 'MEV value ($)', 'moniker']].rename(
+        columns={'height': 'Block Height', 'MEV value ($)': 'MEV Value', 'moniker': 'Proposer'}
+    )
+    text = table.to_string(index=False, formatters={'MEV Value': '${:.2f}'.format})
+    column_header, *rows = html.escape(text).split("\n")
+    return column_header, rows
+
+# Function to split message lines into chunks that fit in a single Telegram message
+def chunk_lines(lines, limit=MAX_MESSAGE_LENGTH):
+    chunks = []
+    current = []
+    current_length = 0
+    for line in lines:
+        # Account for the newline that joins this line to the previous one
+        line_length = len(line) + (1 if current else 0)
+        if current and current_length + line_length > limit:
+            chunks.append("\n".join(current))
+            current = []
+            current_length = 0
+            line_length = len(line)
+        current.append(line)
+        current_length += line_length
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+# Function to build the notification messages, empty when no block is above the threshold
+def build_messages(mev_df, validator_lookup):
+    filtered_df = process_data(mev_df, validator_lookup)
+    if filtered_df.empty:
+        return []
+    title = f"Blocks with MEV value higher than ${settings.threshold}:"
+    column_header, rows = format_blocks(filtered_df)
+    # Leave room for the title, the repeated column header and the <pre> tags in every chunk
+    overhead = len(title) + len(column_header) + len("\n<pre>\n</pre>")
+    chunks = chunk_lines(rows, limit=MAX_MESSAGE_LENGTH - overhead)
+    messages = [f"<pre>{column_header}\n{chunk}</pre>" for chunk in chunks]
+    messages[0] = f"{title}\n{messages[0]}"
+    return messages
 
 # Function to send Telegram message
 async def send_telegram_message(bot, message):
@@ -59,53 +220,99 @@ async def start(update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # Function to check MEV values
-async def check_mev_values():
+async def check_mev_values(bot):
     logging.info("Starting MEV value check")
     try:
-        block_range_response = requests.get("https://dydx.observatory.zone/api/v1/block_range")
-        block_range_response.raise_for_status()
-        block_range = block_range_response.json()
+        block_range = await fetch("https://dydx.observatory.zone/api/v1/block_range")
         final_block_height = int(block_range['lastHeight'])
         logging.info(f"Fetched block range: {block_range}")
-    except (requests.RequestException, ValueError) as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
         logging.error(f"Error fetching the block range: {e}")
         return
 
-    initial_block_height = final_block_height - 50000
-    mev_df = get_mev_data(initial_block_height, final_block_height)
-    validator_df = get_validator_data()
+    if last_seen_height is not None and final_block_height - last_seen_height < MIN_NEW_BLOCKS:
+        logging.info(f"Only {final_block_height - last_seen_height} new block(s) since the last check, skipping")
+        return
+
+    try:
+        mev_df, validator_lookup = await asyncio.gather(
+            get_mev_window(final_block_height),
+            get_validator_lookup(),
+        )
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, ijson.JSONError) as e:
+        logging.error(f"Error fetching MEV or validator data: {e}")
+        return
     
     if mev_df.empty:
         logging.info("No MEV data found")
         return
 
-    filtered_df = process_data(mev_df, validator_df)
-    
-    if filtered_df.empty:
-        logging.info(f"No blocks with MEV value higher than ${settings['threshold']}")
+    # Filtering and formatting are CPU-bound, keep them off the event loop
+    loop = asyncio.get_running_loop()
+    chunks = await loop.run_in_executor(None, build_messages, mev_df, validator_lookup)
+
+    if not chunks:
+        logging.info(f"No blocks with MEV value higher than ${settings.threshold}")
         return
 
-    message = f"Blocks with MEV value higher than ${settings['threshold']}:\n"
-    for _, row in filtered_df.iterrows():
-        message += f"Block Height: {row['height']}, MEV Value: ${row['MEV value ($)']:.2f}, Proposer: {row['moniker']}\n"
+    # Parts of one notification go out in order, so the title arrives first and the chat is not flooded
+    for part, chunk in enumerate(chunks, start=1):
+        for attempt in range(RETRY_ATTEMPTS):
+            try:
+                await send_telegram_message(bot, chunk)
+                break
+            except RetryAfter as e:
+                logging.warning(f"Telegram flood limit hit, resending part {part}/{len(chunks)} in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except TelegramError as e:
+                logging.error(f"Error sending Telegram message part {part}/{len(chunks)}: {e}")
+                return
+        else:
+            logging.error(f"Giving up on Telegram message part {part}/{len(chunks)} after {RETRY_ATTEMPTS} flood waits")
+            return
+    logging.info(f"Telegram message sent in {len(chunks)} part(s)")
 
-    bot = Bot(token=TELEGRAM_TOKEN)
-    await send_telegram_message(bot, message)
-    logging.info("Telegram message sent")
+# Background task running the notification loop
+notifications_task = None
 
-async def main():
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+# Function to run MEV checks on the configured interval
+async def run_notifications(bot):
+    while True:
+        if settings.auto_notify == 'Y':
+            try:
+                await check_mev_values(bot)
+            except Exception:
+                # Keep the scheduler alive, the next interval gets a fresh attempt
+                logging.exception("MEV value check failed")
+        await asyncio.sleep(3600 * settings.interval)
+
+# Function to start the notification loop once the application is initialized
+async def post_init(application):
+    global notifications_task
+    notifications_task = asyncio.create_task(run_notifications(application.bot))
+
+# Function to stop the notification loop and release the HTTP session on shutdown
+async def post_shutdown(application):
+    if notifications_task is not None:
+        notifications_task.cancel()
+    if http_session is not None:
+        await http_session.close()
+
+def main():
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Add command handlers
     application.add_handler(CommandHandler('start', start))
 
-    # Start the bot
+    # Start the bot, run_polling manages the event loop itself
     logging.info('Starting bot...')
-    await application.initialize()
-    await application.start()
-    await application.run_polling()
+    application.run_polling()
 
 if __name__ == "__main__":
-    # Instead of asyncio.run(), we manage the loop directly.
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    main()